@@ -7,39 +7,65 @@ the information into a single email so it's easier to check on a
 daily basis.
 """
 
-from smtplib import SMTP
+from smtplib import SMTP, SMTPException, SMTPServerDisconnected
 from email.mime.multipart import MIMEMultipart      # building new email
 from email.mime.text import MIMEText                # building new email
-from retrying import retry                          # retrying send email
+import tenacity                                     # retrying send email
 import logging                                      # Logger
-import email                                        # Email parsing
+from logging.handlers import MemoryHandler          # Buffered file logging
+import re                                           # Extracting errors
+from functools import lru_cache                     # Caching errors
+from email.parser import BytesFeedParser            # Email parsing
+from email.policy import compat32                   # Email parsing
 import poplib                                       # Get emails from server
-from datetime import datetime                       # get current date/time
-from html2text import html2text                     # plaintext email output
-from more_itertools import unique_everseen          # Removing dupe errors
-import dateutil.parser                              # Parse date from email
-import dateutil.tz                                  # Prase date from email
-# from dateutil import parser, tz                     # Parse date from email
+from queue import Queue                             # Retrieved emails
+from threading import Thread                        # Retrieving emails
+from datetime import datetime, timezone             # get current date/time
+from email.utils import parsedate_to_datetime       # Parse date from email
 from configparser import ConfigParser              # for config INI
 
+# Format for dates shown in summary emails
+DATE_FORMAT = '%a, %-m/%-d/%Y at %I:%M %p'
+
+# Largest email body kept, in characters. Only the end is kept
+# since the backup result is on the last line.
+MAX_BODY_SIZE = 1000000
+
+# Error code line followed by its Message line in Acronis emails
+ERROR_RE = re.compile(r'^(Error code:[^\r\n]*)\r?\n'
+                      r'(?:(?!Error code:)[^\r\n]*\r?\n)*?'
+                      r'Message:([^\r\n]*)', re.M)
+
+# Backup result in last line of Acronis emails
+STATUS_RE = re.compile(r'has (succeeded|failed)')
+
+# HTML color for each backup result, anything else is black
+STATUS_COLORS = {
+    'succeeded': '#006400',     # Success, dark green
+    'failed': '#FF0000',        # Failed, Red
+}
+
+# Root logger, handlers are added by setup_logger so importing this
+# module doesn't create a log file
+logger = logging.getLogger()
+
 
 def setup_logger():
     """
     Setup loggers for file and screen
     """
-    global logger
-
-    # Create logger
-    logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
     formatter = logging.Formatter('%(asctime)s %(name)-12s '
                                   '%(levelname)-8s %(message)s')
 
-    # Log to file
+    # Log to file, buffered so records are written in batches.
+    # Buffer is flushed on errors and when logging shuts down.
     fh = logging.FileHandler('acronsum.log')
     fh.setLevel(logging.INFO)
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
+    mh = MemoryHandler(capacity=1024, flushLevel=logging.ERROR, target=fh)
+    mh.setLevel(logging.INFO)
+    logger.addHandler(mh)
 
     # Log to screen
     ch = logging.StreamHandler()
@@ -54,6 +80,8 @@ def process_emails(mail_server, from_email, to_email, pop_user, pop_password):
     """ Process emails received and generate summary email """
 
     email_data = []
+    # Parsed dates keyed by Date header, emails often share the same one
+    date_cache = {}
 
     m = poplib.POP3_SSL(mail_server)
     m.user(pop_user)
@@ -62,30 +90,68 @@ def process_emails(mail_server, from_email, to_email, pop_user, pop_password):
     num_messages = len(m.list()[1])
 
     if num_messages > 0:
-        # New messages found, process them
-        for i in range(num_messages):
-            raw_email = b"\n".join(m.retr(i+1)[1])
-            parsed_email = email.message_from_bytes(raw_email)
+        # New messages found, process them. They are retrieved in another
+        # thread so the next email downloads while the current one is parsed.
+        raw_queue = Queue(maxsize=4)
+        retriever = Thread(target=retrieve_emails,
+                           args=(m, num_messages, raw_queue), daemon=True)
+        retriever.start()
+        for email_lines in iter(raw_queue.get, None):
+            if isinstance(email_lines, Exception):
+                # Retrieval failed, nothing has been deleted yet
+                raise email_lines
+            # Feed lines to parser as they come rather than joining them
+            # into one large bytes object first, to keep memory use down.
+            feed_parser = BytesFeedParser(policy=compat32)
+            for line in email_lines:
+                feed_parser.feed(line + b'\n')
+            parsed_email = feed_parser.close()
             # Acronis emails are just plain text, but other emails may come to
             # inbox for account so I verify that it's plain text to be safe.
-            for part in parsed_email.walk():
+            # Only the first plain text part is needed, and most emails are
+            # a single part so walk() is only used for multipart ones.
+            if parsed_email.is_multipart():
+                parts = parsed_email.walk()
+            else:
+                parts = (parsed_email,)
+            for part in parts:
                 if part.get_content_type() == 'text/plain':
                     # Parse date so it can be formatted, etc.
-                    # http://stackoverflow.com/a/12160056
-                    email_date = dateutil.parser.parse(parsed_email['Date'])
-                    email_data.append([part.get_payload(), email_date])
+                    date_header = parsed_email['Date']
+                    email_date = date_cache.get(date_header)
+                    if email_date is None:
+                        email_date = parsedate_to_datetime(date_header)
+                        # -0000 zone gives a naive datetime, but it's UTC
+                        if email_date.tzinfo is None:
+                            email_date = email_date.replace(
+                                tzinfo=timezone.utc)
+                        date_cache[date_header] = email_date
+                    payload = part.get_payload(decode=False)
+                    if len(payload) > MAX_BODY_SIZE:
+                        logger.warning('Email body too large, using last '
+                                       '%d characters', MAX_BODY_SIZE)
+                        payload = payload[-MAX_BODY_SIZE:]
+                    email_data.append([payload, email_date])
+                    break
                 else:
-                    logger.info('Ignoring message of type "{}"'
-                                .format(part.get_content_type()))
-            # Delete email
+                    logger.debug('Ignoring message part of type "%s"',
+                                 part.get_content_type())
+        retriever.join()
+
+        # Delete emails only after all have been retrieved, so the
+        # retrieval loop isn't waiting on a DELE round trip per message
+        for i in range(num_messages):
             m.dele(i+1)
 
         try:
-            send_backups_email(mail_server, from_email, to_email, email_data)
+            # Connection is reused for any retries
+            with SmtpClient(mail_server) as smtp_client:
+                send_backups_email(smtp_client, from_email, to_email,
+                                   email_data)
         except Exception as ex:
             # Email failed to send after several retries. Cancel deletes.
             logger.error('Could not send backup log summary email '
-                         'after several attempts: ' + str(ex))
+                         'after several attempts: %s', ex)
             m.rset()
             m.quit()
         else:
@@ -95,115 +161,185 @@ def process_emails(mail_server, from_email, to_email, pop_user, pop_password):
         # No messages found
         m.quit()
         try:
-            send_no_messages_email(mail_server, from_email, to_email)
+            with SmtpClient(mail_server) as smtp_client:
+                send_no_messages_email(smtp_client, from_email, to_email)
         except Exception as ex:
             # Email failed to send after several retries
             logger.error('Could not send backup log empty email '
-                         'after several attempts: ' + str(ex))
+                         'after several attempts: %s', ex)
         else:
             logger.info('Backup log empty email sent')
 
 
+def retrieve_emails(m, num_messages, raw_queue):
+    """
+    Retrieve emails from POP server and queue their lines for parsing.
+    None is queued when done, or the exception if retrieval fails.
+    """
+    try:
+        for i in range(num_messages):
+            raw_queue.put(m.retr(i+1)[1])
+    except Exception as ex:
+        raw_queue.put(ex)
+    else:
+        raw_queue.put(None)
+
+
+@lru_cache(maxsize=256)
 def extract_errors(email_text):
     """
     Extract error information from Acronis email
-    and format in HTML Unordered List
+    as a tuple of unique errors in the order found.
+    Cached since a failing job sends the same email each time.
     """
-    email_lines = email_text.splitlines()
-    backup_errors = []
+    backup_errors = [f'{match.group(1)}:{match.group(2)}'
+                     for match in ERROR_RE.finditer(email_text)]
 
-    for email_line in email_lines:
-        if email_line.startswith('Error code:'):
-            backup_error = email_line
-        elif email_line.startswith('Message:'):
-            backup_error += ':{}'.format(email_line[8:])
-            backup_errors.append(backup_error)
+    # dict keeps insertion order, so this removes dupes in original order
+    return tuple(dict.fromkeys(backup_errors))
 
-    html_output = ('<ul><li>' + '</li><li>'
-                   .join(unique_everseen(backup_errors)) + '</li></ul>')
-    return html_output
 
-
-def send_backups_email(mail_server, from_email, to_email, email_data):
+def send_backups_email(smtp_client, from_email, to_email, email_data):
     """
     Send backups summary email.
     """
-
     msg = MIMEMultipart('alternative')
-    msg['Subject'] = ('Backup Log Summary as of {:%a, %-m/%-d/%Y at %I:%M %p}'
-                      .format(datetime.now()))
+    msg['Subject'] = ('Backup Log Summary as of '
+                      f'{datetime.now():{DATE_FORMAT}}')
     msg['From'] = from_email
     msg['To'] = to_email
 
     # Build HTML message as unordered list
     # Based partly on http://stackoverflow.com/a/10716137
-    linesUL = '<ol>'
+    # Parts are collected in a list and joined once at the end.
+    # Plain text version is built alongside it.
+    ul_parts = ['<ol>']
+    text_parts = []
     for edata in email_data:
         # Make sure edata[0] isn't empty string, it happened
         # once resulting in index out of range error
         if edata[0]:
-            # Grab last line of email and strip period
-            # filter is used to remove empty lines which
-            # will cause errors with rstrip
-            edata_lines = edata[0].splitlines()
-            last_line = list(filter(None, edata_lines))[-1].rstrip('.')
-            formatted_date = (edata[1].astimezone(dateutil.tz.tzlocal())
-                              .strftime('%a, %-m/%-d/%Y at %I:%M %p'))
-
-            if 'has succeeded' in last_line:
-                # Success, dark green
-                htmlColor = '#006400'
-                error_info = ""
-            elif 'has failed' in last_line:
-                # Failed, Red
-                htmlColor = '#FF0000'
-                # Add error info
-                error_info = extract_errors(edata[0])
+            # Grab last non-empty line of email and strip period.
+            # Trailing blank lines are stripped and the line found by
+            # searching back from the end, so the body isn't split up.
+            body = edata[0].rstrip()
+            last_line = body[body.rfind('\n') + 1:].rstrip('.')
+            formatted_date = f'{edata[1].astimezone():{DATE_FORMAT}}'
+
+            status_match = STATUS_RE.search(last_line)
+            status = status_match.group(1) if status_match else None
+            htmlColor = STATUS_COLORS.get(status, '#000000')
+            # Add error info for failures only
+            if status == 'failed':
+                backup_errors = extract_errors(edata[0])
+                error_info = ('<ul><li>' + '</li><li>'.join(backup_errors)
+                              + '</li></ul>')
             else:
-                # ??? Black
-                htmlColor = '#000000'
+                backup_errors = ()
                 error_info = ""
 
-            linesUL += ('<li style="color:{}">{} on {}{}</li>'
-                        .format(htmlColor, last_line,
-                                formatted_date, error_info))
-    linesUL += '</ol>'
-
-    htmlMsg = '<html><head></head><body>{}</body></html>'.format(linesUL)
+            ul_parts.append(f'<li style="color:{htmlColor}">{last_line} '
+                            f'on {formatted_date}{error_info}</li>')
+            # Item number is list items so far, less the opening <ol>
+            text_parts.append(f'{len(ul_parts) - 1}. {last_line} '
+                              f'on {formatted_date}\n')
+            text_parts.extend(f'    * {backup_error}\n'
+                              for backup_error in backup_errors)
+    ul_parts.append('</ol>')
+    linesUL = ''.join(ul_parts)
+
+    htmlMsg = f'<html><head></head><body>{linesUL}</body></html>'
     htmlPart = MIMEText(htmlMsg, 'html')
     msg.attach(htmlPart)
 
-    # Convert html to plain text and attach to message
-    textMsg = html2text(htmlMsg)
+    # Attach plain text version of message
+    textMsg = ''.join(text_parts)
     textPart = MIMEText(textMsg, 'plain')
     msg.attach(textPart)
 
-    send_email(msg, mail_server)
-    logger.debug(textMsg)
+    send_email(msg, smtp_client)
+    # Skip formatting the whole message unless it will be logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s', textMsg)
 
 
-def send_no_messages_email(mail_server, from_email, to_email):
+def send_no_messages_email(smtp_client, from_email, to_email):
     """
     Send email that backup log is empty (in case it shouldn't be.)
     """
 
     msg = MIMEText('The backup log inbox is empty.')
-    msg['Subject'] = ('Backup Log is empty as of {:%a, %-m/%-d/%Y at %I:%M %p}'
-                      .format(datetime.now()))
+    msg['Subject'] = ('Backup Log is empty as of '
+                      f'{datetime.now():{DATE_FORMAT}}')
     msg['From'] = from_email
     msg['To'] = to_email
-    send_email(msg, mail_server)
+    send_email(msg, smtp_client)
 
 
-@retry(wait_fixed=60000, stop_max_attempt_number=15)
-def send_email(msg, mail_server):
+@tenacity.retry(stop=tenacity.stop_after_attempt(15),
+                wait=(tenacity.wait_exponential(multiplier=2, max=120)
+                      + tenacity.wait_random(0, 5)),
+                retry=tenacity.retry_if_exception_type(OSError),
+                reraise=True)
+def send_email(msg, smtp_client):
     """
-    Send email. Retry every minute for up to 15 minutes.
+    Send email. Retry up to 15 times, backing off exponentially to
+    2 minutes between attempts. SMTP errors are OSErrors, so this
+    covers both those and connection failures.
     """
     logger.debug('Attemping to send email')
-    smtp = SMTP(mail_server)
-    smtp.send_message(msg)
-    smtp.quit()
+    smtp_client.send_message(msg)
+
+
+class SmtpClient:
+    """
+    SMTP connection that is opened on first use and reused for
+    later sends, reconnecting only if the server dropped it.
+    """
+
+    def __init__(self, mail_server):
+        self.mail_server = mail_server
+        self.smtp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        """ Open a new connection, closing any existing one """
+        self.close()
+        self.smtp = SMTP(self.mail_server)
+
+    def close(self):
+        """ Close connection if open """
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (SMTPException, OSError):
+                # Already gone, nothing else to clean up
+                pass
+            self.smtp = None
+
+    def is_connected(self):
+        """ Check connection is still alive with a NOOP """
+        if self.smtp is None:
+            return False
+        try:
+            return self.smtp.noop()[0] == 250
+        except (SMTPException, OSError):
+            return False
+
+    def send_message(self, msg):
+        """ Send message, reconnecting once if connection was dropped """
+        if not self.is_connected():
+            self.connect()
+        try:
+            self.smtp.send_message(msg)
+        except SMTPServerDisconnected:
+            self.connect()
+            self.smtp.send_message(msg)
 
 
 def main():
@@ -219,7 +355,7 @@ def main():
         pop_user = config['main']['pop_user']
         pop_password = config['main']['pop_password']
     except Exception as ex:
-        logger.error('Could not load configuration: ' + str(ex))
+        logger.error('Could not load configuration: %s', ex)
     else:
         process_emails(mail_server, from_email, to_email,
                        pop_user, pop_password)